@@ -1,6 +1,11 @@
 import csv
 import itertools
+import math
+import multiprocessing
+import operator
+import os
 import sys
+from array import array
 
 PROBS = {
 
@@ -36,6 +41,56 @@ PROBS = {
     "mutation": 0.01
 }
 
+# Array typecode for probability sums: "f" (float32) halves their size,
+# "d" (float64) keeps full precision
+ACCUMULATOR_TYPECODE = "f"
+
+# Fewest (gene assignment, trait assignment) pairs worth splitting across
+# worker processes
+PARALLEL_MIN_WORK = 1_000_000
+
+# Gene assignments held in memory at once by each process
+CHUNK_SIZE = 4096
+
+# Lookup tables derived from PROBS, indexed by number of genes (and trait)
+GENE_PRIOR = [PROBS["gene"][genes] for genes in range(3)]
+PASS = [PROBS["mutation"], 0.5, 1 - PROBS["mutation"]]
+TRAIT_TABLE = [
+    [PROBS["trait"][genes][False], PROBS["trait"][genes][True]]
+    for genes in range(3)
+]
+
+
+def child_gene_probability(mother_genes, father_genes, genes):
+    """
+    Return the probability that a child has `genes` copies of the gene,
+    given the number of copies each parent has.
+    """
+    pass_mother = PASS[mother_genes]
+    pass_father = PASS[father_genes]
+    if genes == 2:
+        return pass_mother * pass_father
+    elif genes == 1:
+        return (pass_mother * (1 - pass_father) +
+                (1 - pass_mother) * pass_father)
+    else:
+        return (1 - pass_mother) * (1 - pass_father)
+
+
+# CHILD[mother_genes][father_genes][genes]
+CHILD = [
+    [
+        [child_gene_probability(mg, fg, genes) for genes in range(3)]
+        for fg in range(3)
+    ]
+    for mg in range(3)
+]
+
+# Log-space versions of the tables, summed rather than multiplied
+LOG_GENE_PRIOR = [math.log(p) for p in GENE_PRIOR]
+LOG_TRAIT_TABLE = [[math.log(p) for p in row] for row in TRAIT_TABLE]
+LOG_CHILD = [[[math.log(p) for p in row] for row in table] for table in CHILD]
+
 
 def main():
 
@@ -43,47 +98,35 @@ def main():
     if len(sys.argv) != 2:
         sys.exit("Usage: python heredity.py data.csv")
     people = load_data(sys.argv[1])
+    names_list, mother_idx, father_idx, known_mask, trait_mask = (
+        index_people(people)
+    )
+
+    # Sum joint probabilities over every assignment consistent with evidence
+    gene_probs, trait_probs = enumerate_all(
+        mother_idx, father_idx, known_mask, trait_mask
+    )
+
+    # Ensure probabilities sum to 1
+    normalize_arrays(gene_probs, 3)
+    normalize_arrays(trait_probs, 2)
 
     # Keep track of gene and trait probabilities for each person
     probabilities = {
         person: {
             "gene": {
-                2: 0,
-                1: 0,
-                0: 0
+                2: gene_probs[3 * i + 2],
+                1: gene_probs[3 * i + 1],
+                0: gene_probs[3 * i]
             },
             "trait": {
-                True: 0,
-                False: 0
+                True: trait_probs[2 * i + 1],
+                False: trait_probs[2 * i]
             }
         }
-        for person in people
+        for i, person in enumerate(names_list)
     }
 
-    # Loop over all sets of people who might have the trait
-    names = set(people)
-    for have_trait in powerset(names):
-
-        # Check if current set of people violates known information
-        fails_evidence = any(
-            (people[person]["trait"] is not None and
-             people[person]["trait"] != (person in have_trait))
-            for person in names
-        )
-        if fails_evidence:
-            continue
-
-        # Loop over all sets of people who might have the gene
-        for one_gene in powerset(names):
-            for two_genes in powerset(names - one_gene):
-
-                # Update probabilities with new joint probability
-                p = joint_probability(people, one_gene, two_genes, have_trait)
-                update(probabilities, one_gene, two_genes, have_trait, p)
-
-    # Ensure probabilities sum to 1
-    normalize(probabilities)
-
     # Print results
     for person in people:
         print(f"{person}:")
@@ -116,16 +159,54 @@ def load_data(filename):
     return data
 
 
+def index_people(people):
+    """
+    Return a list of names in `people`, along with lists giving the index
+    of each person's mother and father in that list (-1 for no parents),
+    and bitmasks of the people whose trait is known and who have the trait.
+    """
+    names = list(people)
+    index = {name: i for i, name in enumerate(names)}
+    mother_idx = [
+        index[people[name]["mother"]] if people[name]["mother"] else -1
+        for name in names
+    ]
+    father_idx = [
+        index[people[name]["father"]] if people[name]["father"] else -1
+        for name in names
+    ]
+    known_mask = trait_mask = 0
+    for i, name in enumerate(names):
+        if people[name]["trait"] is not None:
+            known_mask |= 1 << i
+            if people[name]["trait"]:
+                trait_mask |= 1 << i
+    return names, mother_idx, father_idx, known_mask, trait_mask
+
+
+def submasks(mask):
+    """
+    Return a list of every bitmask whose set bits are a subset of `mask`.
+    """
+    result = []
+    subset = mask
+    while True:
+        result.append(subset)
+        if subset == 0:
+            return result
+        subset = (subset - 1) & mask
+
+
 def powerset(s):
     """
-    Return a list of all possible subsets of set s.
+    Yield all possible subsets of set s, one at a time.
+    Wrap the result in `list` where a list is needed.
     """
     s = list(s)
-    return [
-        set(s) for s in itertools.chain.from_iterable(
-            itertools.combinations(s, r) for r in range(len(s) + 1)
-        )
-    ]
+    for subset in itertools.chain.from_iterable(
+        itertools.combinations(s, r) for r in range(len(s) + 1)
+    ):
+        yield set(subset)
 
 
 def joint_probability(people, one_gene, two_genes, have_trait):
@@ -139,68 +220,256 @@ def joint_probability(people, one_gene, two_genes, have_trait):
         * everyone in set `have_trait` has the trait, and
         * everyone not in set` have_trait` does not have the trait.
     """
+    # Determine everyone's number of genes up front
+    genes = {
+        person: 2 if person in two_genes else 1 if person in one_gene else 0
+        for person in people
+    }
     probability = 1.0
 
-    for person in people:
-        # Determine the number of genes
-        if person in two_genes:
-            genes = 2
-        elif person in one_gene:
-            genes = 1
-        else:
-            genes = 0
-        
-        # Determine if the person has the trait
-        has_trait = person in have_trait
-        
+    for person, g in genes.items():
+        mother = people[person]["mother"]
+        father = people[person]["father"]
+
         # Calculate the probability of having the given number of genes
-        if people[person]["mother"] is None and people[person]["father"] is None:
-            gene_probability = PROBS["gene"][genes]
+        if mother is None and father is None:
+            gene_probability = GENE_PRIOR[g]
         else:
-            mother = people[person]["mother"]
-            father = people[person]["father"]
-            # Probability that each parent passes the gene
-            if mother in two_genes:
-                pass_mother = 1 - PROBS["mutation"]
-            elif mother in one_gene:
-                pass_mother = 0.5
-            else:
-                pass_mother = PROBS["mutation"]
-            
-            if father in two_genes:
-                pass_father = 1 - PROBS["mutation"]
-            elif father in one_gene:
-                pass_father = 0.5
-            else:
-                pass_father = PROBS["mutation"]
-            
-            if genes == 2:
-                gene_probability = pass_mother * pass_father
-            elif genes == 1:
-                gene_probability = pass_mother * (1 - pass_father) + (1 - pass_mother) * pass_father
-            else:
-                gene_probability = (1 - pass_mother) * (1 - pass_father)
-        
+            gene_probability = CHILD[genes[mother]][genes[father]][g]
+
         # Calculate the probability of having the trait
-        trait_probability = PROBS["trait"][genes][has_trait]
+        trait_probability = TRAIT_TABLE[g][person in have_trait]
 
         # Update the overall probability
         probability *= gene_probability * trait_probability
 
     return probability
 
-# Example usage
-people = {
-    "Harry": {"mother": "Lily", "father": "James", "trait": True},
-    "James": {"mother": None, "father": None, "trait": True},
-    "Lily": {"mother": None, "father": None, "trait": False}
-}
 
-one_gene = {"Harry"}
-two_genes = {"James"}
-have_trait = {"Harry", "James"}
+def compile_kernels(mother_idx, father_idx, known_mask, trait_mask):
+    """
+    Generate source specialized to one pedigree and return two functions:
+
+    * `gene_log_probability(*genes)`, the log probability of a gene
+      assignment for people with parents, together with the known traits
+      (founders' priors come from `founder_log_priors` instead), and
+    * `batch_probabilities(assignments, gene_logps, trait_weights)`, the
+      joint probability of each assignment given `gene_logps` from above
+      and `trait_weights[i][g]`, the log probability of person `i`'s trait
+      (if unknown) given `g` copies of the gene.
+
+    Parent indices and known traits become constants in the source, so the
+    generated code does no lookups into the pedigree itself.
+    """
+    n = len(mother_idx)
+    params = ", ".join(f"g{i}" for i in range(n))
+    target = f"({params},)" if n else "_"
+    unknown = [i for i in range(n) if not known_mask >> i & 1]
+
+    terms = []
+    for i in range(n):
+        if mother_idx[i] >= 0:
+            terms.append(
+                f"LOG_CHILD[g{mother_idx[i]}][g{father_idx[i]}][g{i}]"
+            )
+        if known_mask >> i & 1:
+            terms.append(f"LOG_TRAIT_TABLE[g{i}][{trait_mask >> i & 1}]")
+    trait_terms = "".join(f" + w{i}[g{i}]" for i in unknown)
+
+    source = "\n".join(
+        [
+            f"def gene_log_probability({params}):",
+            "    return (" + ("\n            + ".join(terms) or "0.0") + ")",
+            "",
+            "def batch_probabilities(assignments, gene_logps, trait_weights):",
+        ] + [
+            f"    w{i} = trait_weights[{i}]" for i in unknown
+        ] + [
+            f"    return [exp(logp{trait_terms})",
+            f"            for logp, {target}",
+            "            in zip(gene_logps, assignments)]",
+        ]
+    )
+    namespace = {
+        "exp": math.exp,
+        "LOG_CHILD": LOG_CHILD,
+        "LOG_TRAIT_TABLE": LOG_TRAIT_TABLE,
+    }
+    exec(source, namespace)
+    return namespace["gene_log_probability"], namespace["batch_probabilities"]
+
+
+def enumerate_all(mother_idx, father_idx, known_mask, trait_mask,
+                  typecode=None):
+    """
+    Sum joint probabilities over every assignment of genes and traits
+    consistent with the known traits given by `known_mask` and `trait_mask`.
+
+    Assignments are bitmasks over people: bit `i` of `one_gene`, `two_genes`
+    or `have_trait` is set when person `i` is in that set.
+    Return flat arrays `gene_probs` and `trait_probs`, holding the sums for
+    person `i` at `gene_probs[3 * i + genes]` and
+    `trait_probs[2 * i + has_trait]`. The sums share a common scale factor
+    (see `log_scale`), which normalizing removes. The arrays use `typecode`,
+    or `ACCUMULATOR_TYPECODE` if none is given.
+
+    Large enumerations have their `one_gene` masks split across processes.
+    """
+    n = len(mother_idx)
+    typecode = typecode or ACCUMULATOR_TYPECODE
+
+    # Each of the 3^n gene assignments is paired with every trait assignment
+    # that leaves known traits alone
+    unknown = n - known_mask.bit_count()
+    work = 3 ** n * 2 ** unknown
+    workers = min(available_cpus(), 1 << n)
+    if work < PARALLEL_MIN_WORK or workers == 1:
+        return enumerate_genes(
+            mother_idx, father_idx, known_mask, trait_mask, range(1 << n),
+            typecode
+        )
 
-print(joint_probability(people, one_gene, two_genes, have_trait))raise NotImplementedError
+    # Interleave masks so each worker gets a similar number of assignments
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.starmap(enumerate_genes, [
+            (mother_idx, father_idx, known_mask, trait_mask,
+             range(k, 1 << n, workers), typecode)
+            for k in range(workers)
+        ])
+
+    gene_probs, trait_probs = results[0]
+    for gene_part, trait_part in results[1:]:
+        for k, p in enumerate(gene_part):
+            gene_probs[k] += p
+        for k, p in enumerate(trait_part):
+            trait_probs[k] += p
+    return gene_probs, trait_probs
+
+
+def available_cpus():
+    """
+    Return the number of CPUs this process may run on, which can be fewer
+    than the host has (e.g. in a container or under taskset).
+    """
+    if hasattr(os, "process_cpu_count"):
+        return os.process_cpu_count() or 1
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def enumerate_genes(mother_idx, father_idx, known_mask, trait_mask,
+                    one_genes, typecode):
+    """
+    Like `enumerate_all`, but only for gene assignments whose `one_gene`
+    bitmask is in `one_genes`, summing into arrays of type `typecode`.
+    """
+    n = len(mother_idx)
+    people = range(n)
+    everyone = (1 << n) - 1
+
+    founder_mask = sum(1 << i for i in people if mother_idx[i] < 0)
+    gene_log_probability, batch_probabilities = compile_kernels(
+        mother_idx, father_idx, known_mask, trait_mask
+    )
+    gene_probs = array(typecode, [0.0]) * (3 * n)
+    trait_probs = array(typecode, [0.0]) * (2 * n)
+
+    # Only people whose trait is unknown are free to vary
+    traits = []
+    for mask in submasks(everyone & ~known_mask):
+        trait = [((trait_mask | mask) >> i) & 1 for i in people]
+        traits.append((trait, [
+            [LOG_TRAIT_TABLE[g][trait[i]] for g in range(3)] for i in people
+        ]))
+    trait_totals = [0.0] * len(traits)
+
+    # Gene probabilities and known traits are the same for every mask, so
+    # compute them once per assignment; assignments are built and summed
+    # in chunks to keep memory bounded
+    scale = log_scale(mother_idx)
+    founder_logps = founder_log_priors(founder_mask.bit_count())
+    assignments = []
+    gene_logps = []
+    for one_gene in one_genes:
+        n1 = (one_gene & founder_mask).bit_count()
+        for two_genes in submasks(everyone ^ one_gene):
+            n2 = (two_genes & founder_mask).bit_count()
+            genes = tuple([
+                ((two_genes >> i) & 1) * 2 + ((one_gene >> i) & 1)
+                for i in people
+            ])
+            assignments.append(genes)
+            gene_logps.append(
+                founder_logps[n1][n2] + gene_log_probability(*genes) - scale
+            )
+            if len(assignments) == CHUNK_SIZE:
+                sum_chunk(assignments, gene_logps, traits,
+                          batch_probabilities, gene_probs, trait_totals)
+                assignments = []
+                gene_logps = []
+    sum_chunk(assignments, gene_logps, traits, batch_probabilities,
+              gene_probs, trait_totals)
+
+    # Traits are fixed for each mask, so update them once
+    for (trait, _), total in zip(traits, trait_totals):
+        for i in people:
+            trait_probs[2 * i + trait[i]] += total
+
+    return gene_probs, trait_probs
+
+
+def sum_chunk(assignments, gene_logps, traits, batch_probabilities,
+              gene_probs, trait_totals):
+    """
+    Add the joint probabilities of a chunk of gene `assignments`, over every
+    `(trait, trait_weights)` pair in `traits`, to `gene_probs` and to the
+    matching entries of `trait_totals`.
+    """
+    assignment_sums = [0.0] * len(assignments)
+    for k, (_, trait_weights) in enumerate(traits):
+        batch = batch_probabilities(assignments, gene_logps, trait_weights)
+        assignment_sums = list(map(operator.add, assignment_sums, batch))
+        trait_totals[k] += sum(batch)
+
+    # Add each assignment's summed probability to everyone's gene counts
+    for genes, p in zip(assignments, assignment_sums):
+        for i, g in enumerate(genes):
+            gene_probs[3 * i + g] += p
+
+
+def founder_log_priors(founders):
+    """
+    Return a table whose `[n1][n2]` entry is the log prior probability
+    that, of `founders` people with no parents listed, `n1` have one copy
+    of the gene, `n2` have two copies, and the rest have none.
+    """
+    return [
+        [
+            n1 * LOG_GENE_PRIOR[1] + n2 * LOG_GENE_PRIOR[2] +
+            (founders - n1 - n2) * LOG_GENE_PRIOR[0]
+            for n2 in range(founders + 1)
+        ]
+        for n1 in range(founders + 1)
+    ]
+
+
+def log_scale(mother_idx):
+    """
+    Return an upper bound on the log joint probability of any assignment
+    for people with parents `mother_idx`. Subtracting it before `exp` keeps
+    the largest probabilities near 1, so big pedigrees do not underflow.
+    """
+    founder_max = max(
+        LOG_GENE_PRIOR[g] + max(LOG_TRAIT_TABLE[g]) for g in range(3)
+    )
+    child_max = max(
+        LOG_CHILD[mg][fg][g] + max(LOG_TRAIT_TABLE[g])
+        for mg in range(3) for fg in range(3) for g in range(3)
+    )
+    return sum(
+        founder_max if mother < 0 else child_max for mother in mother_idx
+    )
 
 
 def update(probabilities, one_gene, two_genes, have_trait, p):
@@ -210,7 +479,7 @@ def update(probabilities, one_gene, two_genes, have_trait, p):
     Which value for each distribution is updated depends on whether
     the person is in `have_gene` and `have_trait`, respectively.
     """
-   for person in probabilities:
+    for person in probabilities:
         # Determine the number of genes for the person
         genes = (
             2 if person in two_genes
@@ -225,32 +494,6 @@ def update(probabilities, one_gene, two_genes, have_trait, p):
         probabilities[person]["gene"][genes] += p
         probabilities[person]["trait"][has_trait] += p
 
-# Example usage
-probabilities = {
-    "Harry": {
-        "gene": {2: 0, 1: 0, 0: 0},
-        "trait": {True: 0, False: 0}
-    },
-    "James": {
-        "gene": {2: 0, 1: 0, 0: 0},
-        "trait": {True: 0, False: 0}
-    },
-    "Lily": {
-        "gene": {2: 0, 1: 0, 0: 0},
-        "trait": {True: 0, False: 0}
-    }
-}
-
-one_gene = {"Harry"}
-two_genes = {"James"}
-have_trait = {"Harry", "James"}
-p = 0.02
-
-update(probabilities, one_gene, two_genes, have_trait, p)
-
-for person in probabilities:
-    print(f"{person}: {probabilities[person]}")
-
 
 def normalize(probabilities):
     """
@@ -269,5 +512,18 @@ def normalize(probabilities):
             probabilities[person]["trait"][has_trait] /= trait_sum
 
 
+def normalize_arrays(probs, width):
+    """
+    Like `normalize`, but for a flat array (as returned by `enumerate_all`)
+    holding one distribution of `width` values per person.
+    """
+    for start in range(0, len(probs), width):
+        end = start + width
+        total = sum(probs[start:end])
+        probs[start:end] = array(
+            probs.typecode, [p / total for p in probs[start:end]]
+        )
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,109 @@
+import os
+import unittest
+from unittest import mock
+
+import heredity
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# Eight people, three with known traits, so enough work to use the pool
+LARGE_FAMILY = {
+    "A": {"name": "A", "mother": None, "father": None, "trait": False},
+    "B": {"name": "B", "mother": None, "father": None, "trait": None},
+    "C": {"name": "C", "mother": "A", "father": "B", "trait": True},
+    "D": {"name": "D", "mother": None, "father": None, "trait": None},
+    "E": {"name": "E", "mother": "D", "father": "C", "trait": None},
+    "F": {"name": "F", "mother": "D", "father": "C", "trait": False},
+    "G": {"name": "G", "mother": "E", "father": "H", "trait": None},
+    "H": {"name": "H", "mother": None, "father": None, "trait": None},
+}
+
+
+def reference_probabilities(people):
+    """
+    Compute normalized probabilities the slow way, by calling
+    `joint_probability` and `update` for every set of people.
+    """
+    probabilities = {
+        person: {"gene": {2: 0, 1: 0, 0: 0}, "trait": {True: 0, False: 0}}
+        for person in people
+    }
+    names = set(people)
+    for have_trait in heredity.powerset(names):
+        if any(
+            people[person]["trait"] is not None and
+            people[person]["trait"] != (person in have_trait)
+            for person in names
+        ):
+            continue
+        for one_gene in heredity.powerset(names):
+            for two_genes in heredity.powerset(names - one_gene):
+                p = heredity.joint_probability(
+                    people, one_gene, two_genes, have_trait
+                )
+                heredity.update(
+                    probabilities, one_gene, two_genes, have_trait, p
+                )
+    heredity.normalize(probabilities)
+    return probabilities
+
+
+def fast_probabilities(people, **kwargs):
+    """
+    Compute normalized probabilities with `enumerate_all`.
+    """
+    names, mother_idx, father_idx, known_mask, trait_mask = (
+        heredity.index_people(people)
+    )
+    gene_probs, trait_probs = heredity.enumerate_all(
+        mother_idx, father_idx, known_mask, trait_mask, **kwargs
+    )
+    heredity.normalize_arrays(gene_probs, 3)
+    heredity.normalize_arrays(trait_probs, 2)
+    return {
+        person: {
+            "gene": {g: gene_probs[3 * i + g] for g in range(3)},
+            "trait": {t: trait_probs[2 * i + t] for t in (True, False)}
+        }
+        for i, person in enumerate(names)
+    }
+
+
+class EnumerateAllTest(unittest.TestCase):
+
+    def test_joint_probability(self):
+        people = heredity.load_data(os.path.join(DATA, "family0.csv"))
+        p = heredity.joint_probability(people, {"Harry"}, {"James"}, {"James"})
+        self.assertAlmostEqual(p, 0.0026643247488, places=12)
+
+    def assertMatchesReference(self, people, **kwargs):
+        expected = reference_probabilities(people)
+        actual = fast_probabilities(people, **kwargs)
+        for person in people:
+            for field in ("gene", "trait"):
+                for value, p in expected[person][field].items():
+                    self.assertAlmostEqual(
+                        actual[person][field][value], p, delta=1e-5,
+                        msg=f"{person} {field} {value}"
+                    )
+
+    def test_families(self):
+        for i in range(3):
+            with self.subTest(family=i):
+                people = heredity.load_data(
+                    os.path.join(DATA, f"family{i}.csv")
+                )
+                self.assertMatchesReference(people)
+
+    def test_empty_family(self):
+        self.assertEqual(fast_probabilities({}), {})
+
+    def test_large_family_in_pool(self):
+        with mock.patch.object(heredity, "PARALLEL_MIN_WORK", 0), \
+                mock.patch.object(heredity, "available_cpus", return_value=3):
+            self.assertMatchesReference(LARGE_FAMILY)
+            self.assertMatchesReference(LARGE_FAMILY, typecode="d")
+
+
+if __name__ == "__main__":
+    unittest.main()